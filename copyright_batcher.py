@@ -1,227 +1,364 @@
+import gc
+import io
 import os
-import json
-import shutil
+import re
+import orjson
 import logging
 import h5py
+import numpy as np
 from tqdm import tqdm
 from openpyxl import load_workbook
 from PIL import Image, UnidentifiedImageError
 from datetime import datetime, timezone
+from functools import lru_cache
 from dateutil.parser import parse as date_parse
 from dotenv import load_dotenv
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from logging.handlers import RotatingFileHandler
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from multiprocessing import Queue
 import warnings
 import threading
 
-load_dotenv()
-
-# Configure logging with rotating file handlers
-log_file = "logs/batcher.log"
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-handler = RotatingFileHandler(log_file, maxBytes=10*1024*1024, backupCount=5)
-handler.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-logging.getLogger('').addHandler(handler)
-
 # Constants
 BATCH_SIZE = 750
 SUB_BATCH_SIZE = 150
 MAX_DIMENSION = 360
-DEFAULT_DATE = os.getenv("DEFAULT_DATE", "08/2024")
+DATE_TAGS = (
+    "EXIF:DateTimeOriginal", "EXIF:CreateDate", "IPTC:DateCreated",
+    "IPTC:DigitalCreationDate", "XMP:CreateDate", "XMP:DateCreated"
+)
+DATE_FORMATS = (
+    "%Y:%m:%d", "%Y:%m:%d %H:%M:%S", "%Y:%m:%d %H:%M:%S%z", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M:%S%z"
+)
+# Matches "%Y:%m:%d", "%Y:%m:%d %H:%M:%S" and "%Y-%m-%dT%H:%M:%S" values with zero-padded fields
+FAST_DATE_PATTERN = re.compile(r"[0-9]{4}:[0-9]{2}:[0-9]{2}(?: [0-9]{2}:[0-9]{2}:[0-9]{2})?|[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}")
+LOG_FILE = "logs/batcher.log"
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+# Set by setup() from the environment and .env file. Worker processes never call
+# setup(), so anything they run must get its paths through arguments instead.
+LOG_LEVEL = "WARNING"
+DEFAULT_DATE = None
+IMAGE_DIRECTORY_FOLDER = None
+METADATA_HDF5_PATH = None
+OUTPUT_DIR = None
+TEMPLATE_PATH = None
+TEMPLATE_BYTES = None
+
+def setup():
+    global LOG_LEVEL, DEFAULT_DATE, IMAGE_DIRECTORY_FOLDER, METADATA_HDF5_PATH, OUTPUT_DIR, TEMPLATE_PATH, TEMPLATE_BYTES
+    load_dotenv()
+
+    # Configure logging with rotating file handlers
+    # Per-image messages are logged at DEBUG; set LOG_LEVEL=INFO or DEBUG in .env for more detail
+    LOG_LEVEL = os.getenv("LOG_LEVEL", "WARNING").upper()
+    logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
+    handler = RotatingFileHandler(LOG_FILE, maxBytes=10*1024*1024, backupCount=5)
+    handler.setLevel(LOG_LEVEL)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    logging.getLogger('').addHandler(handler)
+
+    # Load environment variables
+    DEFAULT_DATE = os.getenv("DEFAULT_DATE", "08/2024")
+    IMAGE_DIRECTORY_FOLDER = os.getenv("IMAGE_DIRECTORY_FOLDER")
+    METADATA_HDF5_PATH = os.getenv("METADATA_HDF5_PATH", "meta/metadata.hdf5")
+    OUTPUT_DIR = os.getenv("OUTPUT_DIRECTORY_FOLDER")
+    TEMPLATE_PATH = os.getenv("TEMPLATE_PATH")
 
-# Load environment variables
-IMAGE_DIRECTORY_FOLDER = os.getenv("IMAGE_DIRECTORY_FOLDER")
-METADATA_HDF5_PATH = os.getenv("METADATA_HDF5_PATH", "meta/metadata.hdf5")
-OUTPUT_DIR = os.getenv("OUTPUT_DIRECTORY_FOLDER")
-TEMPLATE_PATH = os.getenv("TEMPLATE_PATH")
+    # Check if environment variables are loaded correctly
+    if not IMAGE_DIRECTORY_FOLDER or not METADATA_HDF5_PATH or not OUTPUT_DIR or not TEMPLATE_PATH:
+        raise ValueError("One or more environment variables are missing. Please check the .env file.")
 
-# Check if environment variables are loaded correctly
-if not IMAGE_DIRECTORY_FOLDER or not METADATA_HDF5_PATH or not OUTPUT_DIR or not TEMPLATE_PATH:
-    raise ValueError("One or more environment variables are missing. Please check the .env file.")
+    # Read the template once; each batch parses its own workbook from these bytes
+    with open(TEMPLATE_PATH, "rb") as template_file:
+        TEMPLATE_BYTES = template_file.read()
 
-if not os.path.exists(OUTPUT_DIR):
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    if not os.path.exists(OUTPUT_DIR):
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-if not os.path.exists(os.path.dirname(METADATA_HDF5_PATH)):
-    os.makedirs(os.path.dirname(METADATA_HDF5_PATH), exist_ok=True)
+    if not os.path.exists(os.path.dirname(METADATA_HDF5_PATH)):
+        os.makedirs(os.path.dirname(METADATA_HDF5_PATH), exist_ok=True)
+
+# Pool initializer: worker processes hand their log records to the main process,
+# which is the only one writing to (and rotating) the log file
+def init_worker(log_queue, log_level):
+    root = logging.getLogger()
+    root.handlers = [QueueHandler(log_queue)]
+    root.setLevel(log_level)
+
+# List the image directory once, keeping each file's mtime from the same scan
+def scan_image_directory():
+    with os.scandir(IMAGE_DIRECTORY_FOLDER) as entries:
+        return [(entry.name, entry.stat().st_mtime) for entry in entries if entry.is_file()]
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
 
 # Create new metadata HDF5 file
-def create_metadata_hdf5():
+def create_metadata_hdf5(json_files):
     logging.info(f"Creating a new metadata HDF5 file '{METADATA_HDF5_PATH}'.")
     metadata = {}
-    json_files = [f for f in os.listdir(IMAGE_DIRECTORY_FOLDER) if f.endswith(".json")]
-    with h5py.File(METADATA_HDF5_PATH, "w") as f:
-        for json_file in json_files:
-            json_path = os.path.join(IMAGE_DIRECTORY_FOLDER, json_file)
-            try:
-                with open(json_path, "r") as jf:
-                    metadata_content = json.load(jf)
-                    if isinstance(metadata_content, list):
-                        metadata_content = metadata_content[0]  # Assuming the first item is the dictionary
-                    if isinstance(metadata_content, dict):
-                        f.create_dataset(json_file.replace(".json", ""), data=json.dumps(metadata_content))
-                        metadata[json_file.replace(".json", "")] = metadata_content
-                    else:
-                        logging.warning(f"Unexpected metadata format in file: {json_path}")
-            except Exception as e:
-                logging.error(f"Error reading JSON file {json_path}: {e}")
+    names = []
+    values = []
+    json_paths = [os.path.join(IMAGE_DIRECTORY_FOLDER, json_file) for json_file in json_files]
+
+    # Reading many small files is I/O bound, so read them concurrently and parse here
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+        futures = [executor.submit(read_file, json_path) for json_path in json_paths]
+
+    for json_file, json_path, future in zip(json_files, json_paths, futures):
+        try:
+            metadata_content = orjson.loads(future.result())
+            if isinstance(metadata_content, list):
+                metadata_content = metadata_content[0]  # Assuming the first item is the dictionary
+            if isinstance(metadata_content, dict):
+                image_name = json_file.replace(".json", "")
+                names.append(image_name)
+                values.append(orjson.dumps(metadata_content).decode())
+                metadata[image_name] = metadata_content
+            else:
+                logging.warning(f"Unexpected metadata format in file: {json_path}")
+        except Exception as e:
+            logging.error(f"Error reading JSON file {json_path}: {e}")
+    del futures  # Drop the raw JSON bytes, only the parsed dicts are kept
+
+    # Store everything as two parallel string datasets rather than one dataset per image,
+    # plus the list of JSON files it was built from so later runs can tell when it is stale.
+    # Written to a temporary file first so an interrupted run never leaves a partial file behind.
+    tmp_path = METADATA_HDF5_PATH + ".tmp"
+    with h5py.File(tmp_path, "w") as f:
+        f.create_dataset("names", data=np.array(names, dtype=h5py.string_dtype()))
+        f.create_dataset("metadata", data=np.array(values, dtype=h5py.string_dtype()))
+        f.create_dataset("json_files", data=np.array(json_files, dtype=h5py.string_dtype()))
+    os.replace(tmp_path, METADATA_HDF5_PATH)
     logging.info("Created metadata HDF5 file from JSON files")
     print(f"Created metadata for {len(metadata)} images")
     return metadata
 
-# Load metadata from HDF5 file
-def load_metadata_from_hdf5():
+# Load metadata from HDF5 file; returns None if the file must be rebuilt
+def load_metadata_from_hdf5(json_files):
     metadata = {}
-    with h5py.File(METADATA_HDF5_PATH, "r") as f:
-        for image_name in f.keys():
-            try:
-                metadata_content = json.loads(f[image_name][()])
-                if isinstance(metadata_content, list):
-                    metadata_content = metadata_content[0]  # Assuming the first item is the dictionary
-                if isinstance(metadata_content, dict):
-                    metadata[image_name] = metadata_content
-                else:
-                    logging.warning(f"Unexpected metadata format in dataset: {image_name}")
-            except Exception as e:
-                logging.error(f"Error reading dataset {image_name} from HDF5 file: {e}")
+    try:
+        with h5py.File(METADATA_HDF5_PATH, "r") as f:
+            stored_json_files = f["json_files"].asstr()[()]
+            names = f["names"].asstr()[()]
+            values = f["metadata"].asstr()[()]
+    except (OSError, KeyError) as e:
+        # Unreadable, or written by an older version with one dataset per image
+        logging.warning(f"Could not read metadata HDF5 file '{METADATA_HDF5_PATH}', rebuilding it: {e}")
+        return None
+    if set(stored_json_files) != set(json_files):
+        logging.info("JSON files were added or removed since the metadata HDF5 file was created, rebuilding it")
+        return None
+    for image_name, value in zip(names, values):
+        try:
+            metadata_content = orjson.loads(value)
+            if isinstance(metadata_content, list):
+                metadata_content = metadata_content[0]  # Assuming the first item is the dictionary
+            if isinstance(metadata_content, dict):
+                metadata[image_name] = metadata_content
+            else:
+                logging.warning(f"Unexpected metadata format for image: {image_name}")
+        except Exception as e:
+            logging.error(f"Error reading metadata for {image_name} from HDF5 file: {e}")
     logging.info("Loaded metadata from HDF5 file")
     print(f"Loaded metadata for {len(metadata)} images")
     return metadata
 
+@lru_cache(maxsize=None)
+def parse_date(date_str):
+    date_str = date_str.split('.')[0]
+    # Strings shaped exactly like one of the zero-padded formats without a timezone skip strptime;
+    # anything else (including values those formats would reject) goes through the strptime loop
+    try:
+        if not FAST_DATE_PATTERN.fullmatch(date_str):
+            raise ValueError(date_str)
+        date = datetime(int(date_str[0:4]), int(date_str[5:7]), int(date_str[8:10]),
+                        int(date_str[11:13] or 0), int(date_str[14:16] or 0), int(date_str[17:19] or 0))
+    except ValueError:
+        for date_format in DATE_FORMATS:
+            try:
+                date = datetime.strptime(date_str, date_format)
+                break
+            except ValueError as e:
+                logging.debug("Failed to parse date %s with format %s: %s", date_str, date_format, e)
+        else:
+            return None
+    # Make sure all dates are naive or convert to a common timezone
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date
+
 def extract_date(metadata):
     dates = []
-    date_tags = [
-        "EXIF:DateTimeOriginal", "EXIF:CreateDate", "IPTC:DateCreated", 
-        "IPTC:DigitalCreationDate", "XMP:CreateDate", "XMP:DateCreated"
-    ]
-    date_formats = [
-        "%Y:%m:%d", "%Y:%m:%d %H:%M:%S", "%Y:%m:%d %H:%M:%S%z", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M:%S%z"
-    ]
-
-    for tag in date_tags:
+    for tag in DATE_TAGS:
         date_str = metadata.get(tag)
         if date_str:
-            for date_format in date_formats:
-                try:
-                    date = datetime.strptime(date_str.split('.')[0], date_format)
-                    # Make sure all dates are naive or convert to a common timezone
-                    if date.tzinfo is None:
-                        date = date.replace(tzinfo=timezone.utc)
-                    dates.append(date)
-                    logging.info(f"Extracted date from tag: {tag} -> {date.strftime('%m/%Y')}")
-                    break
-                except ValueError as e:
-                    logging.debug(f"Failed to parse date {date_str} with format {date_format}: {e}")
-                    continue
+            date = parse_date(date_str)
+            if date is not None:
+                dates.append(date)
+                logging.debug("Extracted date from tag: %s -> %02d/%d", tag, date.month, date.year)
 
     if dates:
         latest_date = max(dates)
-        logging.info(f"Using latest extracted date: {latest_date.strftime('%m/%Y')}")
+        logging.debug("Using latest extracted date: %02d/%d", latest_date.month, latest_date.year)
         return latest_date.strftime("%m/%Y")
     else:
-        logging.info(f"No valid date found in metadata, using default date {DEFAULT_DATE}")
+        logging.debug("No valid date found in metadata, using default date %s", DEFAULT_DATE)
         return DEFAULT_DATE
 
 def resize_image(image_path, output_path):
+    # Save under a temporary name and move it into place, so an interrupted save never
+    # leaves a truncated image that looks up to date on the next run
+    tmp_path = os.path.join(os.path.dirname(output_path), f".{os.path.basename(output_path)}.tmp")
     try:
         with Image.open(image_path) as img:
-            logging.info(f"Opened image for resizing: {image_path}")
+            logging.debug("Opened image for resizing: %s", image_path)
+            # thumbnail() already lets the JPEG decoder downscale via draft() before the LANCZOS pass
             img.thumbnail((MAX_DIMENSION, MAX_DIMENSION), Image.LANCZOS)
-            img.save(output_path)
-            logging.info(f"Resized image saved to {output_path}")
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+            img.save(tmp_path, "JPEG", quality=85, optimize=False, progressive=False, subsampling="4:2:0")
+        os.replace(tmp_path, output_path)
+        logging.debug("Resized image saved to %s", output_path)
     except Exception as e:
         logging.error(f"Error resizing image {image_path}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
         raise
 
-def process_image(image, batch_dir, worksheet, idx, metadata):
-    img_path = os.path.join(IMAGE_DIRECTORY_FOLDER, image)
-    logging.info(f"Processing image: {img_path}")
-    image_metadata = metadata.get(image.replace('.jpg', ''), {})
-    if not image_metadata:
-        logging.warning(f"No metadata found for image: {image}")
+def is_up_to_date(output_path, source_mtime):
     try:
-        metadata_date = extract_date(image_metadata)
-    except Exception as e:
-        logging.error(f"Error extracting date for image {image}: {e}")
+        return os.stat(output_path).st_mtime >= source_mtime
+    except FileNotFoundError:
         return False
 
-    resized_img_path = os.path.join(batch_dir, image)
+# Runs in a worker process, so it must not touch the worksheet or module settings
+def resize_one(img_path, resized_img_path, source_mtime):
+    logging.debug("Processing image: %s", img_path)
+
+    if is_up_to_date(resized_img_path, source_mtime):
+        logging.debug("Resized image already up to date: %s", resized_img_path)
+        return True
     try:
         resize_image(img_path, resized_img_path)
     except FileNotFoundError as e:
         logging.error(f"File not found: {img_path}. Error: {e}")
         return False
+    except Exception as e:
+        logging.error(f"Error processing image {img_path}: {e}")
+        return False
+    return True
 
+def write_image_row(worksheet, idx, image, metadata_date):
     worksheet.cell(row=idx + 11, column=1).value = idx + 1
     worksheet.cell(row=idx + 11, column=2).value = image
     worksheet.cell(row=idx + 11, column=3).value = image
     worksheet.cell(row=idx + 11, column=4).value = metadata_date
     worksheet.cell(row=idx + 11, column=5).value = image
     worksheet.cell(row=idx + 11, column=6).value = ""
-    return True
 
-def process_batch(images, batch_number, metadata, year):
+# Queue a batch's resizing on the shared pool and return what process_batch needs to finish it
+def submit_batch(executor, images, batch_number, year, image_mtimes):
     batch_dir = os.path.join(OUTPUT_DIR, f"{year}_batch_{batch_number}")
     os.makedirs(batch_dir, exist_ok=True)
 
-    wb = load_workbook(TEMPLATE_PATH)
-    ws = wb.active
+    # Resized images are written straight into their sub-batch directory
+    sub_batch_dirs = [os.path.join(batch_dir, f"sub_batch_{j // SUB_BATCH_SIZE + 1}") for j in range(0, len(images), SUB_BATCH_SIZE)]
+    for sub_batch_dir in sub_batch_dirs:
+        os.makedirs(sub_batch_dir, exist_ok=True)
+    img_paths = [os.path.join(IMAGE_DIRECTORY_FOLDER, image) for image in images]
+    resized_img_paths = [os.path.join(sub_batch_dirs[idx // SUB_BATCH_SIZE], image) for idx, image in enumerate(images)]
 
-    with ThreadPoolExecutor() as executor:
-        futures = [executor.submit(process_image, image, batch_dir, ws, idx, metadata) for idx, image in enumerate(images)]
-        for future in tqdm(as_completed(futures), total=len(futures), desc=f"Processing batch {batch_number} for {year}"):
-            try:
-                result = future.result()
-                if not result:
-                    logging.warning(f"Image processing failed for an image")
-            except Exception as e:
-                logging.error(f"Error processing image: {e}")
+    source_mtimes = [image_mtimes[image] for image in images]
+
+    results = executor.map(resize_one, img_paths, resized_img_paths, source_mtimes, chunksize=16)
+    return images, batch_number, year, batch_dir, results
+
+def process_batch(images, batch_number, year, batch_dir, results, image_dates):
+    # Every batch's resizes are already queued, so parsing and saving this workbook overlaps with the workers
+    processed = []
+    for image, result in tqdm(zip(images, results), total=len(images), desc=f"Processing batch {batch_number} for {year}", mininterval=1.0, miniters=50):
+        if not result:
+            logging.warning(f"Image processing failed for image: {image}")
+        processed.append(result)
+
+    wb = load_workbook(io.BytesIO(TEMPLATE_BYTES))
+    ws = wb.active
+    for idx, (image, result) in enumerate(zip(images, processed)):
+        if result:
+            write_image_row(ws, idx, image, image_dates[image][1])
 
     output_xlsx = os.path.join(batch_dir, f"diversity_photos_batch_{batch_number}.xlsx")
     wb.save(output_xlsx)
 
-    for j in range(0, len(images), SUB_BATCH_SIZE):
-        sub_batch = images[j:j + SUB_BATCH_SIZE]
-        sub_batch_dir = os.path.join(batch_dir, f"sub_batch_{j // SUB_BATCH_SIZE + 1}")
-        os.makedirs(sub_batch_dir, exist_ok=True)
-        for image in sub_batch:
-            resized_img_path = os.path.join(batch_dir, image)
-            if not os.path.exists(resized_img_path):
-                logging.warning(f"Resized image not found: {resized_img_path}")
-                continue
-            try:
-                shutil.copy(resized_img_path, os.path.join(sub_batch_dir, image))
-                logging.info(f"Copied {resized_img_path} to {os.path.join(sub_batch_dir, image)}")
-            except FileNotFoundError as e:
-                logging.error(f"File not found during copy: {resized_img_path}. Error: {e}")
-
     logging.info(f"Processed batch {batch_number} for {year}")
 
 def process_images():
-    images = [f for f in os.listdir(IMAGE_DIRECTORY_FOLDER) if f.endswith(".jpg")]
+    files = scan_image_directory()
+    images = [name for name, _ in files if name.endswith(".jpg")]
+    json_files = [(name, mtime) for name, mtime in files if name.endswith(".json")]
     print(f"Found {len(images)} images")
     images.sort()
 
-    metadata = create_metadata_hdf5()  # Always create new metadata HDF5 file
-
-    # Group images by year
-    images_by_year = {}
-    for image in images:
-        image_metadata = metadata.get(image.replace('.jpg', ''), {})
-        date_str = extract_date(image_metadata)
-        year = date_str.split("/")[1]
-        if year not in images_by_year:
-            images_by_year[year] = []
-        images_by_year[year].append(image)
-
-    # Process each group of images by year
-    for year, year_images in images_by_year.items():
-        for i in tqdm(range(0, len(year_images), BATCH_SIZE), desc=f"Processing batches for {year}"):
-            batch = year_images[i:i + BATCH_SIZE]
-            batch_number = i // BATCH_SIZE + 1
-            process_batch(batch, batch_number, metadata, year)
+    # Only rebuild the metadata HDF5 file when a JSON file is newer than it,
+    # JSON files were added or removed, or the file cannot be read
+    json_names = [name for name, _ in json_files]
+    newest_json = max((mtime for _, mtime in json_files), default=0)
+    metadata = None
+    if os.path.exists(METADATA_HDF5_PATH) and os.path.getmtime(METADATA_HDF5_PATH) >= newest_json:
+        metadata = load_metadata_from_hdf5(json_names)
+    if metadata is None:
+        metadata = create_metadata_hdf5(json_names)
+    # Free the JSON/HDF5 intermediates before the image work starts
+    gc.collect()
+
+    # Worker processes log through this queue; the listener writes their records with our handlers
+    log_queue = Queue()
+    log_listener = QueueListener(log_queue, *logging.getLogger().handlers, respect_handler_level=True)
+    log_listener.start()
+    try:
+        run_batches(images, dict(files), metadata, log_queue)
+    finally:
+        log_listener.stop()
+
+def run_batches(images, image_mtimes, metadata, log_queue):
+    # Extract each image's date once and bucket it by year; a bucket is sent
+    # off for resizing as soon as it holds a full batch, while dates are still being parsed
+    image_dates = {}
+    buckets = {}
+    batch_numbers = {}
+    pending = []
+    with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=init_worker, initargs=(log_queue, LOG_LEVEL)) as executor:
+        image_stems = [image[:-4] for image in images]  # Strip ".jpg" to get the metadata key
+        for image, stem in zip(images, image_stems):
+            image_metadata = metadata.get(stem, {})
+            if not image_metadata:
+                logging.warning(f"No metadata found for image: {image}")
+            try:
+                date_str = extract_date(image_metadata)
+            except Exception as e:
+                logging.error(f"Error extracting date for image {image}: {e}")
+                continue
+            year = date_str.split("/")[1]
+            image_dates[image] = (year, date_str)
+            bucket = buckets.setdefault(year, [])
+            bucket.append(image)
+            if len(bucket) == BATCH_SIZE:
+                batch_numbers[year] = batch_numbers.get(year, 0) + 1
+                pending.append(submit_batch(executor, bucket, batch_numbers[year], year, image_mtimes))
+                buckets[year] = []
+
+        # Flush the partially filled buckets
+        for year, bucket in buckets.items():
+            if bucket:
+                batch_numbers[year] = batch_numbers.get(year, 0) + 1
+                pending.append(submit_batch(executor, bucket, batch_numbers[year], year, image_mtimes))
+
+        for batch in tqdm(pending, desc="Processing batches"):
+            process_batch(*batch, image_dates)
 
 if __name__ == "__main__":
+    setup()
     process_images()